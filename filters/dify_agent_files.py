@@ -4,25 +4,122 @@ authors: Estel
 author_url: https://github.com/azdolinski
 funding_url: https://github.com/azdolinski
 version: 0.1
+requirements: requests, requests-toolbelt, httpx[http2]
 description: This process is used for DIFY's API interface to interact with DIFY's API
 """
 
 import logging
 import os
+import asyncio
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import json
+import hashlib
+import itertools
+import tempfile
+import threading
 import time
-from typing import List, Union, Generator, Iterator, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    BinaryIO,
+    List,
+    Union,
+    Generator,
+    Iterator,
+    Optional,
+)
 from pydantic import BaseModel, Field
 from open_webui.utils.misc import pop_system_message
 from open_webui.config import UPLOAD_DIR
-import base64
-import tempfile
+import binascii
 from urllib.parse import quote
 from io import BytesIO
 
-# Debug mode
-DEBUG_MODE = True
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Debug output is controlled by the logger level
+logger = logging.getLogger(__name__)
+
+# Server-sent event payload prefix
+_SSE_DATA_PREFIX = b"data: "
+_SSE_DATA_PREFIX_LEN = len(_SSE_DATA_PREFIX)
+
+# With Valves.RESPONSE_CACHE, answers for fresh conversations are reused for
+# identical queries within the TTL
+_RESPONSE_CACHE_SIZE = 256
+_RESPONSE_CACHE_TTL = 300  # seconds
+
+# Least recently used chats are evicted from the persisted state beyond these limits
+_MAX_CHATS = 1000
+_CHAT_TTL = 30 * 24 * 3600  # seconds since the chat was last used
+
+# DifyAPI file type by upper-case file extension, anything else is "custom"
+_EXT_TO_TYPE = {
+    **dict.fromkeys(
+        (
+            "TXT",
+            "MD",
+            "MARKDOWN",
+            "PDF",
+            "HTML",
+            "XLSX",
+            "XLS",
+            "DOC",
+            "DOCX",
+            "CSV",
+            "EML",
+            "MSG",
+            "PPTX",
+            "PPT",
+            "XML",
+            "EPUB",
+        ),
+        "document",
+    ),
+    **dict.fromkeys(("JPG", "JPEG", "PNG", "GIF", "WEBP", "SVG"), "image"),
+    **dict.fromkeys(("MP3", "M4A", "WAV", "WEBM", "AMR"), "audio"),
+    **dict.fromkeys(("MP4", "MOV", "MPEG", "MPGA"), "video"),
+}
+
+
+def json_dumps(obj) -> bytes:
+    # Serialize to indented UTF-8 JSON bytes, preferring orjson when available
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def json_loads(data):
+    # Parse JSON from bytes, memoryview or str, preferring orjson when available
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+async def aiter_lines_bytes(response: httpx.Response) -> AsyncIterator[bytes]:
+    # Split a streamed response into lines without decoding them.
+    # No chunk_size: a sized aiter_bytes() holds data back until the chunk is full,
+    # which would batch up the streamed tokens
+    buffer = b""
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer.rstrip(b"\r")
 
 
 def get_file_extension(file_name: str) -> str:
@@ -31,11 +128,20 @@ def get_file_extension(file_name: str) -> str:
 
 # Get closure variables from __event_emitter__
 def get_closure_info(func):
+    # Reuse the context resolved by a previous call on the same emitter
+    cached = getattr(func, "_cached_ctx", None)
+    if cached is not None:
+        return cached
     # Get the function's closure variables
-    if hasattr(func, "__closure__") and func.__closure__:
-        for cell in func.__closure__:
-            if isinstance(cell.cell_contents, dict):
-                return cell.cell_contents
+    for cell in getattr(func, "__closure__", None) or ():
+        contents = cell.cell_contents
+        if isinstance(contents, dict) and "chat_id" in contents:
+            try:
+                func._cached_ctx = contents
+            except AttributeError:
+                # Bound methods and builtins do not accept new attributes
+                pass
+            return contents
     return None
 
 
@@ -47,23 +153,63 @@ class Pipe:
         FILE_SERVER: str = Field(default="http://192.168.1.5/v1/files/upload")
         DIFY_WORKFLOW: str = Field(default="Dify_API_GPT4o")
         DIFY_MODLE_ID: str = Field(default="dify_id")
+        # Reuse answers to identical first messages; a cached answer creates no
+        # Dify conversation, so the next turn starts a fresh one
+        RESPONSE_CACHE: bool = Field(default=False)
 
     def __init__(self):
         
-        # If file not exist.. create empty
-        if not os.path.exists("data/dify/dify_file_data.json"):
-            with open("data/dify/dify_file_data.json", "w", encoding="utf-8") as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
-        
         self.type = "manifold"
         self.id = "dify"
         self.name = "dify/"
-        self.chat_message_mapping = {}
-        self.dify_chat_model = {}
-        self.dify_file_list = {}
+        # Ordered from least to most recently used chat
+        self.chat_message_mapping = OrderedDict()
+        self.dify_chat_model = OrderedDict()
+        self.dify_file_list = OrderedDict()
         self.data_cache_dir = "/data/dify"
+        # Create data cache directory once instead of on every save_state
+        # exist_ok=True means no error will be raised if directory already exists
+        os.makedirs(self.data_cache_dir, exist_ok=True)
+        # Precomputed state and upload paths
+        self._chat_mapping_path = os.path.join(
+            self.data_cache_dir, "chat_message_mapping.json"
+        )
+        self._chat_model_path = os.path.join(self.data_cache_dir, "chat_model.json")
+        self._file_list_path = os.path.join(self.data_cache_dir, "file_list.json")
+        self._file_info_path = os.path.abspath("data/dify/dify_file_data.json")
+        self._uploads_dir = os.path.abspath("data/uploads")
+        # State files are written from worker threads, one writer at a time
+        self._state_lock = threading.Lock()
+        # Snapshot order, so an older snapshot never overwrites a newer one
+        self._state_generation = itertools.count()
+        self._written_generation = {}
+
+        # If file not exist.. create empty
+        if not os.path.exists(self._file_info_path):
+            os.makedirs(os.path.dirname(self._file_info_path), exist_ok=True)
+            self._write_state_file(self._file_info_path, json_dumps({}))
+
+        # Parsed dify_file_data.json and the st_mtime_ns it was read at
+        self._file_info_cache = (None, 0)
+        # State sections changed since the last save_state
+        self._dirty = {"mapping": False, "model": False, "files": False}
+        # Cache key -> (timestamp, answer)
+        self._response_cache = OrderedDict()
         self.load_state()
         self.valves = self.Valves()
+        # Shared session keeps connections to the Dify host alive between requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.2),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Chat streams share one event loop and are multiplexed over HTTP/2
+        self.async_client = httpx.AsyncClient(
+            http2=True, timeout=httpx.Timeout(60.0, connect=3.05)
+        )
 
 
 
@@ -72,71 +218,174 @@ class Pipe:
         """
         Persist Dify-related state variables to files
         The main purpose of this function is to save program runtime state information to local files,
-        allowing the program to restore its previous state after a restart
+        allowing the program to restore its previous state after a restart.
+        Only sections marked dirty since the last save are written.
         """
-        # Create data cache directory if it doesn't exist
-        # exist_ok=True means no error will be raised if directory already exists
-        os.makedirs(self.data_cache_dir, exist_ok=True)
+        self._write_state_files(self._dump_dirty_state())
 
-        # 1. Save chat message mapping relationship
-        # chat_message_mapping.json stores the mapping between chat IDs and DIFY message IDs
-        chat_mapping_file = os.path.join(
-            self.data_cache_dir, "chat_message_mapping.json"
-        )
-        # Open file for writing, using UTF-8 encoding to support all characters
-        with open(chat_mapping_file, "w", encoding="utf-8") as f:
-            # json.dump converts Python objects to JSON format and writes to file
-            # ensure_ascii=False allows writing non-ASCII characters
-            # indent=2 sets 2-space indentation for better readability
-            json.dump(self.chat_message_mapping, f, ensure_ascii=False, indent=2)
-
-        # 2. Save chat model information
-        # chat_model.json stores the model information used for each chat
-        chat_model_file = os.path.join(self.data_cache_dir, "chat_model.json")
-        with open(chat_model_file, "w", encoding="utf-8") as f:
-            json.dump(self.dify_chat_model, f, ensure_ascii=False, indent=2)
-
-        # 3. Save file list information
-        # file_list.json stores information about uploaded files
-        file_list_file = os.path.join(self.data_cache_dir, "file_list.json")
-        with open(file_list_file, "w", encoding="utf-8") as f:
-            json.dump(self.dify_file_list, f, ensure_ascii=False, indent=2)
+    def _dump_dirty_state(self) -> List[tuple]:
+        """
+        Serialize the dirty state sections and clear their dirty flags
+        Must run on the thread that modifies the state dicts; the returned
+        (path, data, generation) tuples can be written from any thread.
+        """
+        sections = {
+            # chat_message_mapping.json stores the mapping between chat IDs and DIFY message IDs
+            "mapping": (self._chat_mapping_path, self.chat_message_mapping),
+            # chat_model.json stores the model information used for each chat
+            "model": (self._chat_model_path, self.dify_chat_model),
+            # file_list.json stores information about uploaded files
+            "files": (self._file_list_path, self.dify_file_list),
+        }
+        dumps = []
+        for section, dirty in self._dirty.items():
+            if dirty:
+                path, obj = sections[section]
+                dumps.append((path, json_dumps(obj), next(self._state_generation)))
+                self._dirty[section] = False
+        return dumps
+
+    def _write_state_files(self, dumps: List[tuple]):
+        """Write snapshots from _dump_dirty_state, skipping any older than the file on disk"""
+        with self._state_lock:
+            for path, data, generation in dumps:
+                if generation < self._written_generation.get(path, -1):
+                    continue
+                self._replace_file(path, data)
+                self._written_generation[path] = generation
+
+    def _mark_dirty(self, *sections):
+        """Flag state sections ("mapping", "model", "files") for the next save_state"""
+        for section in sections:
+            self._dirty[section] = True
+
+    def _write_state_file(self, path: str, data: bytes):
+        """Atomically write serialized JSON to path"""
+        with self._state_lock:
+            self._replace_file(path, data)
+
+    def _replace_file(self, path: str, data: bytes):
+        """Replace path with data; callers hold _state_lock"""
+        # Write to a uniquely named sibling temp file first so a crash never leaves
+        # truncated JSON and concurrent writers never share a temp file
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path),
+            prefix=f"{os.path.basename(path)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            tmp_path = f.name
+            try:
+                f.write(data)
+                # Make sure the data is on disk before the rename makes it visible
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, path)
 
     def load_state(self):
         """Load Dify-related state variables from files"""
         try:
             # chat_message_mapping.json
-            chat_mapping_file = os.path.join(
-                self.data_cache_dir, "chat_message_mapping.json"
-            )
-            if os.path.exists(chat_mapping_file):
-                with open(chat_mapping_file, "r", encoding="utf-8") as f:
-                    self.chat_message_mapping = json.load(f)
+            if os.path.exists(self._chat_mapping_path):
+                with open(self._chat_mapping_path, "rb") as f:
+                    self.chat_message_mapping = OrderedDict(json_loads(f.read()))
             else:
-                self.chat_message_mapping = {}
+                self.chat_message_mapping = OrderedDict()
 
             # chat_model.json
-            chat_model_file = os.path.join(self.data_cache_dir, "chat_model.json")
-            if os.path.exists(chat_model_file):
-                with open(chat_model_file, "r", encoding="utf-8") as f:
-                    self.dify_chat_model = json.load(f)
+            if os.path.exists(self._chat_model_path):
+                with open(self._chat_model_path, "rb") as f:
+                    self.dify_chat_model = OrderedDict(json_loads(f.read()))
             else:
-                self.dify_chat_model = {}
+                self.dify_chat_model = OrderedDict()
 
             # file_list.json
-            file_list_file = os.path.join(self.data_cache_dir, "file_list.json")
-            if os.path.exists(file_list_file):
-                with open(file_list_file, "r", encoding="utf-8") as f:
-                    self.dify_file_list = json.load(f)
+            if os.path.exists(self._file_list_path):
+                with open(self._file_list_path, "rb") as f:
+                    self.dify_file_list = OrderedDict(json_loads(f.read()))
             else:
-                self.dify_file_list = {}
+                self.dify_file_list = OrderedDict()
 
         except Exception as e:
-            print(f"Failed to load Dify state files: {e}")
+            logger.error("Failed to load Dify state files: %s", e)
             # Use empty dictionaries if loading fails
-            self.chat_message_mapping = {}
-            self.dify_chat_model = {}
-            self.dify_file_list = {}
+            self.chat_message_mapping = OrderedDict()
+            self.dify_chat_model = OrderedDict()
+            self.dify_file_list = OrderedDict()
+
+    def _touch_chat(self, chat_id: str):
+        """Mark a chat as most recently used and evict stale or excess chats"""
+        # Recency is tracked on chat_message_mapping only, the other dicts follow it
+        self.chat_message_mapping[chat_id]["last_access_ts"] = time.time()
+        self.chat_message_mapping.move_to_end(chat_id)
+        self._mark_dirty("mapping")
+        self._evict_chats()
+
+    def _evict_chats(self):
+        """Drop least recently used chats above _MAX_CHATS or older than _CHAT_TTL"""
+        now = time.time()
+        while self.chat_message_mapping:
+            oldest_id, oldest = next(iter(self.chat_message_mapping.items()))
+            # Entries saved before access tracking count as fresh
+            expired = now - oldest.get("last_access_ts", now) > _CHAT_TTL
+            if len(self.chat_message_mapping) <= _MAX_CHATS and not expired:
+                break
+            del self.chat_message_mapping[oldest_id]
+            self.dify_chat_model.pop(oldest_id, None)
+            self.dify_file_list.pop(oldest_id, None)
+            self._mark_dirty("mapping", "model", "files")
+
+    def _load_file_info(self) -> dict:
+        """Load dify_file_data.json, re-reading it only when its mtime changed"""
+        mtime = os.stat(self._file_info_path).st_mtime_ns
+        file_info, cached_mtime = self._file_info_cache
+        if file_info is None or mtime != cached_mtime:
+            with open(self._file_info_path, "rb") as f:
+                file_info = json_loads(f.read())
+            self._file_info_cache = (file_info, mtime)
+        return file_info
+
+    def _save_file_info(self, file_info: dict):
+        """Write dify_file_data.json and keep the in-memory cache in sync"""
+        self._write_state_file(self._file_info_path, json_dumps(file_info))
+        self._file_info_cache = (
+            file_info,
+            os.stat(self._file_info_path).st_mtime_ns,
+        )
+
+    def _get_cached_response(self, cache_key: bytes) -> Optional[str]:
+        """Return a cached answer if still fresh"""
+        entry = self._response_cache.get(cache_key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > _RESPONSE_CACHE_TTL:
+            del self._response_cache[cache_key]
+            return None
+        self._response_cache.move_to_end(cache_key)
+        return entry[1]
+
+    def _cache_response(self, cache_key: bytes, answer: str):
+        """Store an answer in the LRU response cache, evicting the oldest entries"""
+        self._response_cache[cache_key] = (time.monotonic(), answer)
+        self._response_cache.move_to_end(cache_key)
+        while len(self._response_cache) > _RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+
+    def _record_dify_message(
+        self, chat_id, message_id, dify_conversation_id, dify_message_id
+    ):
+        """Save conversation and message ID mapping; the caller persists it"""
+        self.chat_message_mapping[chat_id][
+            "dify_conversation_id"
+        ] = dify_conversation_id
+        self.chat_message_mapping[chat_id]["messages"].append(
+            {message_id: dify_message_id}
+        )
+        self._mark_dirty("mapping")
 
     def get_models(self):
         """
@@ -146,13 +395,20 @@ class Pipe:
             {"id": self.valves.DIFY_MODLE_ID, "name": self.valves.DIFY_WORKFLOW},
         ]
 
-    def upload_file(self, user_id: str, file_path: str, mime_type: str) -> str:
+    def upload_file(
+        self,
+        user_id: str,
+        file_obj: Union[str, BinaryIO],
+        file_name: str,
+        mime_type: str,
+    ) -> str:
         """
         Upload file to DIFY server
 
         Args:
             user_id: User ID
-            file_path: File path
+            file_obj: File path or binary file-like object to upload
+            file_name: File name sent to the server
             mime_type: File MIME type
 
         Returns:
@@ -169,33 +425,37 @@ class Pipe:
                 "Authorization": f"Bearer {self.valves.DIFY_KEY}",
             }
 
-            file_name = os.path.basename(file_path)
-
-            # Use 'with' statement to ensure proper file closure
-            with open(file_path, "rb") as file:
-                files = {
-                    "file": (file_name, file, mime_type),
-                    "user": (None, user_id),
-                }
-                response = requests.post(
-                    url, headers=headers, files=files, timeout=(5, 30)
+            # Use ExitStack to ensure proper closure of files opened from a path
+            with ExitStack() as stack:
+                if isinstance(file_obj, str):
+                    file_obj = stack.enter_context(open(file_obj, "rb"))
+                # Stream the multipart body from the file instead of buffering it
+                encoder = MultipartEncoder(
+                    fields={
+                        "file": (file_name, file_obj, mime_type),
+                        "user": user_id,
+                    }
+                )
+                headers["Content-Type"] = encoder.content_type
+                response = self.session.post(
+                    url, headers=headers, data=encoder, timeout=(5, 30)
                 )
                 response.raise_for_status()  # Check response status
 
-                result = response.json()
+                result = json_loads(response.content)
                 if "id" not in result:
                     raise ValueError(f"Invalid server response format: {result}")
 
                 return result["id"]
 
         except FileNotFoundError:
-            logging.error(f"File not found: {file_path}")
+            logger.error("File not found: %s", file_name)
             raise
         except requests.exceptions.RequestException as e:
-            logging.error(f"File upload failed: {str(e)}")
+            logger.error("File upload failed: %s", e)
             raise
         except Exception as e:
-            logging.error(f"Error processing file: {str(e)}")
+            logger.error("Error processing file: %s", e)
             raise
 
     def upload_images(self, image_data_base64: str, user_id: str) -> str:
@@ -209,18 +469,13 @@ class Pipe:
                 # Extract the base64 data after the comma
                 image_data_base64 = image_data_base64.split(",", 1)[1]
 
-            # Decode base64 image data
-            image_data = base64.b64decode(image_data_base64)
+            # Decode base64 image data with the C decoder directly
+            image_data = binascii.a2b_base64(image_data_base64)
 
-            # Create and save temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-                tmp_file.write(image_data)
-                temp_file_path = tmp_file.name
-            try:
-                file_id = self.upload_file(user_id, temp_file_path, "image/png")
-            finally:
-                os.remove(temp_file_path)
-            return file_id
+            # Upload straight from memory, no temporary file needed
+            image_file = BytesIO(image_data)
+            image_file.name = "image.png"
+            return self.upload_file(user_id, image_file, "image.png", "image/png")
         except Exception as e:
             raise ValueError(f"Failed to process base64 image data: {str(e)}")
 
@@ -233,31 +488,25 @@ class Pipe:
         __event_emitter__: dict,
         __user__: Optional[dict],
         __task__=None,
-    ) -> Union[str, Generator, Iterator]:
+    ) -> Union[str, Generator, Iterator, AsyncGenerator]:
         # Main process
-        if DEBUG_MODE:
-            print("-----------------------------------------------------------------")
-            print("Debug - Pipe Function ")
-            print(f"body:{body}")
-            print(f"__task__:{__task__}")
-            print("-----------------------------------------------------------------")
         # Get model name
         model_name = body["model"][body["model"].find(".") + 1 :]
-        # Handle special tasks
-        if __task__ is not None:
-            if __task__ == "title_generation":
-                return model_name
-            elif __task__ == "tags_generation":
-                return f'{{"tags":[{model_name}]}}'
+        # Handle special tasks before any message processing
+        if __task__ == "title_generation":
+            return model_name
+        elif __task__ == "tags_generation":
+            return f'{{"tags":[{model_name}]}}'
+
+        logger.debug("Pipe Function - body: %s, __task__: %s", body, __task__)
 
         # Get current user
         current_user = __user__["email"]
 
         # Handle system messages and regular messages
         system_message, messages = pop_system_message(body["messages"])
-        if DEBUG_MODE:
-            print(f"system_message:{system_message}")
-            print(f"messages:{messages}, {len(messages)}")
+        logger.debug("system_message: %s", system_message)
+        logger.debug("messages: %s, %d", messages, len(messages))
 
         # Get chat_id and message_id from event_emitter
         cell_contents = get_closure_info(__event_emitter__)
@@ -274,6 +523,7 @@ class Pipe:
                 "messages": [],
             }
             self.dify_file_list[chat_id] = {}
+            self._mark_dirty("mapping", "model", "files")
         else:
             # Check if history exists
             if chat_id in self.chat_message_mapping:
@@ -286,6 +536,7 @@ class Pipe:
                 else:
                     # If somehow the model wasn't recorded (exceptional case), record the current model
                     self.dify_chat_model[chat_id] = model_name
+                    self._mark_dirty("model")
 
                 chat_history = self.chat_message_mapping[chat_id]["messages"]
                 current_msg_index = len(messages) - 1  # Index of the current message
@@ -298,6 +549,17 @@ class Pipe:
                     self.chat_message_mapping[chat_id]["messages"] = chat_history[
                         :current_msg_index
                     ]
+                    self._mark_dirty("mapping")
+            else:
+                # History was evicted or lost, continue as a new Dify conversation
+                self.dify_chat_model[chat_id] = model_name
+                self.chat_message_mapping[chat_id] = {
+                    "dify_conversation_id": "",
+                    "messages": [],
+                }
+                self.dify_file_list[chat_id] = {}
+                self._mark_dirty("mapping", "model", "files")
+        self._touch_chat(chat_id)
         # Get the last message as query
         message = messages[-1]
         query = ""
@@ -311,72 +573,52 @@ class Pipe:
         }
         # Process message content
         if isinstance(message.get("content"), list):
+            images = []
             for item in message["content"]:
                 if item["type"] == "text":
                     query += item["text"]
                 if item["type"] == "image_url":
-                    upload_file_id = self.upload_images(
-                        item["image_url"]["url"], current_user
+                    images.append(item["image_url"]["url"])
+            if images:
+                # Uploads are independent round-trips, run them concurrently
+                with ThreadPoolExecutor(max_workers=min(8, len(images))) as executor:
+                    upload_file_ids = list(
+                        executor.map(
+                            lambda image: self.upload_images(image, current_user),
+                            images,
+                        )
                     )
+                for upload_file_id in upload_file_ids:
                     upload_file_dict = {
                         "type": "image",
                         "transfer_method": "local_file",
                         "url": "",
                         "upload_file_id": upload_file_id,
                     }
-                    print("-----------------4------------------")
                     file_list.append(upload_file_dict)
         else:
             query = message.get("content", "")
 
 
-        with open("data/dify/dify_file_data.json", "r", encoding="utf-8") as f:
-            file_info = json.load(f)
-        
-        if DEBUG_MODE:
-            print(f"file_info:{file_info}")
+        file_info = self._load_file_info()
+
+        logger.debug("file_info: %s", file_info)
         if file_info.get("flag", False) is True:
             file_info["flag"] = False
-            with open("data/dify/dify_file_data.json", "w", encoding="utf-8") as f:
-                json.dump(file_info, f, ensure_ascii=False, indent=2)
+            self._save_file_info(file_info)
             url = f"{self.valves.DIFY_BASE_URL}/files/upload"
             try:
                 file_name = file_info["name"]
                 file_extension = get_file_extension(file_name).upper()
                 # Determine file type based on DifyAPI file extension
-                file_type = "custom"  # Default type
-                if file_extension in [
-                    "TXT",
-                    "MD",
-                    "MARKDOWN",
-                    "PDF",
-                    "HTML",
-                    "XLSX",
-                    "XLS",
-                    "DOC",
-                    "DOCX",
-                    "CSV",
-                    "EML",
-                    "MSG",
-                    "PPTX",
-                    "PPT",
-                    "XML",
-                    "EPUB",
-                ]:
-                    file_type = "document"
-                elif file_extension in ["JPG", "JPEG", "PNG", "GIF", "WEBP", "SVG"]:
-                    file_type = "image"
-                elif file_extension in ["MP3", "M4A", "WAV", "WEBM", "AMR"]:
-                    file_type = "audio"
-                elif file_extension in ["MP4", "MOV", "MPEG", "MPGA"]:
-                    file_type = "video"
+                file_type = _EXT_TO_TYPE.get(file_extension, "custom")
                 file_DYFI_FILE_ID = self._get_file_dify_server(
                     file_info["user_id"],
                     f"{file_info['id']}_{file_info['name']}",
                 )
                 # file_path_url=f"{file_info['id']}_{file_info['name']}"
                 # file_DYFI_FILE_ID=self.upload_file(file_id,f"data/uploads/{file_path_url}",file_type)
-                print(f"------------------file_DYFI_FILE_ID: {file_DYFI_FILE_ID}")
+                logger.debug("file_DYFI_FILE_ID: %s", file_DYFI_FILE_ID)
 
                 file_list.append(
                     {
@@ -385,9 +627,11 @@ class Pipe:
                         "upload_file_id": file_DYFI_FILE_ID["id"],
                     }
                 )
-                print(f"Successfully added file: {file_name}, type: {file_type}")
+                logger.info(
+                    "Successfully added file: %s, type: %s", file_name, file_type
+                )
             except Exception as e:
-                print(f"Failed to process file {file_name}: {str(e)}")
+                logger.error("Failed to process file %s: %s", file_name, e)
 
 
 
@@ -405,9 +649,8 @@ class Pipe:
             "user": current_user,
             "files": file_list,
         }
-        if DEBUG_MODE:
-            print(f"file_list: {file_list}")
-            print(f"payload: {payload}")
+        logger.debug("file_list: %s", file_list)
+        logger.debug("payload: %s", payload)
         
         # Set request headers
         headers = {
@@ -417,44 +660,83 @@ class Pipe:
 
         url = f"{self.valves.DIFY_BASE_URL}/chat-messages"
 
+        # Only fresh conversations are cached, the answer must not depend on history
+        cache_key = None
+        if (
+            self.valves.RESPONSE_CACHE
+            and parent_message_id is None
+            and not payload["conversation_id"]
+        ):
+            cache_key = hashlib.blake2b(
+                json_dumps(
+                    [
+                        model_name,
+                        current_user,
+                        query,
+                        inputs["system_message"],
+                        sorted(f["upload_file_id"] for f in file_list),
+                    ]
+                )
+            ).digest()
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                # Never reuse another chat's Dify ids, the chat mapping stays empty
+                # so the next turn starts its own Dify conversation
+                self.save_state()
+                return cached
+
         try:
             if body.get("stream", False):
-                print(f"Streaming {payload}")
-                return self.stream_response(url, headers, payload, chat_id, message_id)
+                logger.debug("Streaming %s", payload)
+                return self.stream_response(
+                    url, headers, payload, chat_id, message_id, cache_key
+                )
             else:
-                print(f"Non-streaming {payload}")
+                logger.debug("Non-streaming %s", payload)
                 return self.non_stream_response(
-                    url, headers, payload, chat_id, message_id
+                    url, headers, payload, chat_id, message_id, cache_key
                 )
         except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+            logger.error("Request failed: %s", e)
             return f"Error: Request failed: {e}"
         except Exception as e:
-            print(f"Error in pipe method: {e}")
+            logger.error("Error in pipe method: %s", e)
             return f"Error: {e}"
 
-    def stream_response(self, url, headers, payload, chat_id, message_id):
+    async def stream_response(
+        self, url, headers, payload, chat_id, message_id, cache_key=None
+    ):
         """Handle streaming response"""
+        # The full answer is only needed when it is going to be cached
+        answer_parts = [] if cache_key is not None else None
         try:
-            with requests.post(
-                url, headers=headers, json=payload, stream=True, timeout=(3.05, 60)
+            async with self.async_client.stream(
+                "POST", url, headers=headers, json=payload
             ) as response:
                 if response.status_code != 200:
+                    await response.aread()
                     raise Exception(
                         f"HTTP Error {response.status_code}: {response.text}"
                     )
 
-                for line in response.iter_lines():
+                # Handle each SSE line as soon as it arrives, keeping it as raw bytes
+                async for line in aiter_lines_bytes(response):
                     if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
+                        # Keep the line as bytes, json_loads parses UTF-8 bytes directly
+                        if line[:_SSE_DATA_PREFIX_LEN] == _SSE_DATA_PREFIX:
                             try:
-                                data = json.loads(line[6:])
+                                # memoryview slices the payload without copying it
+                                data = json_loads(
+                                    memoryview(line)[_SSE_DATA_PREFIX_LEN:]
+                                )
                                 event = data.get("event")
 
                                 if event == "message":
                                     # Process plain text messages
-                                    yield data.get("answer", "")
+                                    answer = data.get("answer", "")
+                                    if answer_parts is not None:
+                                        answer_parts.append(answer)
+                                    yield answer
                                 elif event == "message_file":
                                     # Process file (image) messages
                                     pass
@@ -465,87 +747,95 @@ class Pipe:
                                     )
                                     dify_message_id = data.get("message_id", "")
 
-                                    self.chat_message_mapping[chat_id][
-                                        "dify_conversation_id"
-                                    ] = dify_conversation_id
-                                    self.chat_message_mapping[chat_id][
-                                        "messages"
-                                    ].append({message_id: dify_message_id})
-
-                                    # Save state
-                                    self.save_state()
+                                    self._record_dify_message(
+                                        chat_id,
+                                        message_id,
+                                        dify_conversation_id,
+                                        dify_message_id,
+                                    )
+                                    # Snapshot the state here, only the fsynced writes run off the event loop
+                                    await asyncio.to_thread(
+                                        self._write_state_files,
+                                        self._dump_dirty_state(),
+                                    )
+                                    if cache_key is not None:
+                                        self._cache_response(
+                                            cache_key, "".join(answer_parts)
+                                        )
                                     break
                                 elif event == "error":
                                     # Handle errors
                                     error_msg = f"Error {data.get('status')}: {data.get('message')} ({data.get('code')})"
                                     yield f"Error: {error_msg}"
                                     break
-
-                                time.sleep(0.01)
                             except json.JSONDecodeError:
-                                print(f"Failed to parse JSON: {line}")
+                                logger.warning("Failed to parse JSON: %s", line)
                             except KeyError as e:
-                                print(f"Unexpected data structure: {e}")
-                                print(f"Full data: {data}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+                                logger.warning("Unexpected data structure: %s", e)
+                                logger.debug("Full data: %s", data)
+        except httpx.HTTPError as e:
+            logger.error("Request failed: %s", e)
             yield f"Error: Request failed: {e}"
         except Exception as e:
-            print(f"General error in stream_response method: {e}")
+            logger.error("General error in stream_response method: %s", e)
             yield f"Error: {e}"
 
-    def non_stream_response(self, url, headers, payload, chat_id, message_id):
+    def non_stream_response(
+        self, url, headers, payload, chat_id, message_id, cache_key=None
+    ):
         """Handle non-streaming response"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 url, headers=headers, json=payload, timeout=(3.05, 60)
             )
             if response.status_code != 200:
                 raise Exception(f"HTTP Error {response.status_code}: {response.text}")
 
-            res = response.json()
+            res = json_loads(response.content)
 
             # Save conversation and message ID mapping
             dify_conversation_id = res.get("conversation_id", "")
             dify_message_id = res.get("message_id", "")
 
-            self.chat_message_mapping[chat_id][
-                "dify_conversation_id"
-            ] = dify_conversation_id
-            self.chat_message_mapping[chat_id]["messages"].append(
-                {message_id: dify_message_id}
+            self._record_dify_message(
+                chat_id, message_id, dify_conversation_id, dify_message_id
             )
-
-            # Save state
             self.save_state()
 
-            return res.get("answer", "")
+            answer = res.get("answer", "")
+            if cache_key is not None:
+                self._cache_response(cache_key, answer)
+            return answer
         except requests.exceptions.RequestException as e:
-            print(f"Failed non-stream request: {e}")
+            logger.error("Failed non-stream request: %s", e)
             return f"Error: {e}"
 
     def _get_file_dify_server(self, User_id: str, file_name: str) -> str:
         # Read file from local uploads directory and upload to DIFY server in multipart/form-data format
         try:
             # Build local file path
-            local_file_path = os.path.join("data/uploads", file_name)
-            if DEBUG_MODE:
-                print(f"Reading local file: {local_file_path}")
+            local_file_path = os.path.join(self._uploads_dir, file_name)
+            logger.debug("Reading local file: %s", local_file_path)
 
             upload_url = self.valves.FILE_SERVER
             headers = {"Authorization": f"Bearer {self.valves.DIFY_KEY}"}
 
             # Prepare file data and user ID
             with open(local_file_path, "rb") as file:
-                files = {"file": (file_name, file, "application/octet-stream")}
-                data = {"user": User_id}  # Add user ID parameter
+                # Stream the multipart body from the file instead of buffering it
+                encoder = MultipartEncoder(
+                    fields={
+                        "file": (file_name, file, "application/octet-stream"),
+                        "user": User_id,  # Add user ID parameter
+                    }
+                )
+                headers["Content-Type"] = encoder.content_type
 
                 # Send POST request
-                response = requests.post(
+                response = self.session.post(
                     upload_url,
                     headers=headers,
-                    files=files,
-                    data=data,
+                    data=encoder,
                     timeout=(5, 30),  # Connection timeout 5 seconds, read timeout 30 seconds
                 )
                 # Check response
@@ -554,25 +844,24 @@ class Pipe:
                 except requests.exceptions.HTTPError as e:
                     error_msg = f"HTTP Error: {e.response.status_code}"
                     if response.headers.get("content-type") == "application/json":
-                        error_detail = response.json()
+                        error_detail = json_loads(response.content)
                         error_msg += f" - {error_detail.get('message', '')}"
-                    logging.error(error_msg)
+                    logger.error(error_msg)
                     raise
 
-                result = response.json()
+                result = json_loads(response.content)
                 required_fields = ["id", "name"]
                 if not all(field in result for field in required_fields):
                     raise ValueError(f"Invalid server response format: {result}")
-                if DEBUG_MODE:
-                    print(f"File upload successful: {result}")
+                logger.debug("File upload successful: %s", result)
                 return result
 
         except FileNotFoundError:
-            logging.error(f"File not found: {local_file_path}")
+            logger.error("File not found: %s", local_file_path)
             raise
         except requests.exceptions.RequestException as e:
-            logging.error(f"File upload failed: {str(e)}")
+            logger.error("File upload failed: %s", e)
             raise
         except Exception as e:
-            logging.error(f"File processing failed: {str(e)}")
+            logger.error("File processing failed: %s", e)
             raise
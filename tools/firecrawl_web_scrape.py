@@ -5,24 +5,25 @@ author: Artur Zdolinski
 author_url: https://github.com/azdolinski
 git_url: https://github.com/azdolinski/firecrawl
 required_open_webui_version: 0.4.0
-requirements: requests, urllib3, pydantic, html2text, tiktoken
+requirements: urllib3, pydantic, markdownify, tiktoken, lxml, aiohttp, orjson
 version: 0.6.0 [2024-12-04]
 licence: MIT
 """
 
-import json
+import orjson
 import logging
 import asyncio
-import requests
+import aiohttp
 from typing import Any, Callable, List, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 import urllib3
-from bs4 import BeautifulSoup
-import html2text
-from pprint import pprint
+from lxml import html as lxml_html, etree
+from markdownify import MarkdownConverter
 from datetime import datetime
 from textwrap import dedent
 import re
+import time
+from collections import OrderedDict
 import tiktoken
 
 
@@ -30,6 +31,41 @@ import tiktoken
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Precompiled text_cleaner patterns
+_RE_BACKSLASHES = re.compile(r'\\+')
+# Negated character classes leave a single way to match, so there is no backtracking;
+# excluding newlines keeps matches within one line like the original .*?
+_RE_LOCAL_LINKS = re.compile(r'\[[^\]\n]*\]\((?!(?:https?:|mailto:))[^)\n]*\)')
+_RE_PAREN_PATHS = re.compile(r'\(/?[^)]*?/[^)]+\)')
+_RE_RULE_LINES = re.compile(r'^[=\-#\*]{3,}$', re.MULTILINE)
+_RE_BLANK_LINES = re.compile(r'\n\s*\n')
+_RE_TRIM_LINES = re.compile(r'^\s+|\s+$', re.MULTILINE)
+
+# Scraped page content is reused for repeated scrapes of the same URL
+_CACHE_TTL = 300  # seconds
+_CACHE_SIZE = 128
+
+# Shared aiohttp session, connections are pooled across web_scrape calls
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Get or create the shared aiohttp session."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=10),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared aiohttp session, if it is open."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
         self.event_emitter = event_emitter
@@ -60,7 +96,7 @@ class Tools:
         firecrawl_api_key: str = ""
         formats: List[str] = Field(
             default=["markdown"] ,
-            description='Output formats for the scraped content: markdown, html, rawHtml, links, screenshot. Extra post processing HTML function -> html2text, html2bs4'
+            description='Output formats for the scraped content: markdown, html, rawHtml, links, screenshot. Extra post processing HTML function -> html2text (cleaned Markdown), html2bs4 (opt-in, cleaned HTML for when a structured DOM string is needed)'
         )
 
         # Optional fields with defaults
@@ -102,10 +138,25 @@ class Tools:
             alias="waitFor"
         )
 
+        # Cached result of the dict() filter below, reset whenever a valve changes
+        _payload_extras: Optional[dict] = PrivateAttr(default=None)
+
         class Config:
             populate_by_name = True
             arbitrary_types_allowed = True
 
+        def __setattr__(self, name, value):
+            super().__setattr__(name, value)
+            if not name.startswith("_"):
+                self._payload_extras = None
+
+        @property
+        def payload_extras(self) -> dict:
+            """Optional request parameters that differ from the Firecrawl defaults."""
+            if self._payload_extras is None:
+                self._payload_extras = self.dict(exclude={'firecrawl_api_url', 'firecrawl_api_key', 'formats'})
+            return self._payload_extras
+
         def dict(self, *args, **kwargs):
             # Get the base dictionary
             base_dict = super().dict(*args, exclude_none=True, by_alias=True, **kwargs)
@@ -131,8 +182,21 @@ class Tools:
     def __init__(self):
         """Initialize the Tool with default values."""
         self.valves = self.Valves()
-        self._session = None
-        self._skip_html = False
+        # (url, formats) -> (monotonic timestamp, result), least recently used first
+        self._cache: OrderedDict = OrderedDict()
+        # Stateless converter, safe to share between pages and worker threads
+        self._markdown_converter = MarkdownConverter(
+            heading_style="ATX",                          # nagłówki jako '#'
+            strip=["a", "img", "b", "strong", "i", "em"],  # ignoruje linki, obrazy i pogrubienia/kursywy
+            wrap=False,                                   # wyłącza zawijanie tekstu
+            bs4_options="lxml",                           # parser w C zamiast html.parser
+        )
+        # Post-processing per output format, called with (format data, cleaned html)
+        self._formatters = {
+            "markdown": lambda data, html: self.text_cleaner(data),
+            "html2text": lambda data, html: str(self.text_cleaner(self.html_clean_html2text(html))),
+            "html2bs4": lambda data, html: self.text_cleaner(html),
+        }
 
     def num_tokens_from_string(self, string: str, encoding_name: str) -> int:
         """Returns the number of tokens in a text string."""
@@ -143,70 +207,77 @@ class Tools:
 
     def text_cleaner(self, text):
         """Cleans up the text by removing extra whitespaces, newlines, and unwanted URLs."""
+        # Each pattern below needs a specific character, skip the regex when it is absent
+        cleaned_text = text
+
         # Remove escaped backslashes
-        cleaned_text = re.sub(r'\\+', '', text)
+        if '\\' in cleaned_text:
+            cleaned_text = _RE_BACKSLASHES.sub('', cleaned_text)
         
         # Remove URLs that don't start with http or mailto
-        cleaned_text = re.sub(r'\[.*?\]\((?!(?:http|mailto:)).*?\)', '', cleaned_text)  # Remove markdown links
-        cleaned_text = re.sub(r'\(/?[^)]*?/[^)]+\)', '', cleaned_text)  # Remove parenthesized paths
+        if '[' in cleaned_text:
+            cleaned_text = _RE_LOCAL_LINKS.sub('', cleaned_text)  # Remove markdown links
+        if '(' in cleaned_text:
+            cleaned_text = _RE_PAREN_PATHS.sub('', cleaned_text)  # Remove parenthesized paths
         
         # Remove lines that consist of repeated characters (like ===, ---, ###)
-        cleaned_text = re.sub(r'^[=\-#\*]{3,}$', '', cleaned_text, flags=re.MULTILINE)
+        cleaned_text = _RE_RULE_LINES.sub('', cleaned_text)
         
         # Remove empty lines and extra whitespace
-        cleaned_text = re.sub(r'\n\s*\n', '\n', cleaned_text)  # Replace multiple newlines with single
-        cleaned_text = re.sub(r'^\s+|\s+$', '', cleaned_text, flags=re.MULTILINE)  # Remove leading/trailing whitespace
+        cleaned_text = _RE_BLANK_LINES.sub('\n', cleaned_text)  # Replace multiple newlines with single
+        cleaned_text = _RE_TRIM_LINES.sub('', cleaned_text)  # Remove leading/trailing whitespace
         
         # Remove any remaining empty lines
         cleaned_text = '\n'.join(line for line in cleaned_text.splitlines() if line.strip())
         
         return cleaned_text.strip()
 
+    def _parse_once(self, html_content):
+        """Parses HTML into a single lxml tree shared by all html2* formats.
+
+        Returns None when there is no element to parse (empty, whitespace or comment-only input).
+        """
+        if not html_content or not html_content.strip():
+            return None
+        # Parse UTF-8 bytes with an explicit parser: lxml rejects str input that carries
+        # an XML encoding declaration (XHTML pages starting with <?xml ... encoding=...?>)
+        try:
+            return lxml_html.fromstring(
+                html_content.encode("utf-8"),
+                parser=lxml_html.HTMLParser(encoding="utf-8"),
+            )
+        except etree.ParserError:
+            return None
+
     def html_clean_bs4(self, html_content):
-        """Performs a quick cleanup of common unwanted HTML tags and attributes."""
-        soup = BeautifulSoup(html_content, 'html.parser')
+        """Performs a quick cleanup of common unwanted HTML tags and attributes.
+
+        Accepts raw HTML or a tree from _parse_once, which is cleaned in place.
+        """
+        tree = self._parse_once(html_content) if isinstance(html_content, str) or html_content is None else html_content
+        if tree is None:
+            return ""
 
         # Remove commonly unwanted tags (adjust as needed)
-        tags_to_remove = ['script', 'style', 'head', 'iframe', 'meta', 'svg'] #Add more as you like.
-        for tag in soup.find_all(tags_to_remove):
-            tag.decompose()
+        etree.strip_elements(tree, 'script', 'style', 'head', 'iframe', 'meta', 'svg', with_tail=False) #Add more as you like.
 
         # Remove attributes (adjust as needed)
-        attrs_to_remove = ['class', 'style'] #Add more as you like.
-        for tag in soup.find_all(attrs=True):
-            for attr in attrs_to_remove:
-                if attr in tag.attrs:
-                    del tag.attrs[attr]
-
+        etree.strip_attributes(tree, 'class', 'style') #Add more as you like.
 
         #Remove empty tags. This part is potentially fragile as it can delete empty tags you *want* to keep.
-        for tag in soup.find_all():
-            if not tag.contents and tag.name not in ['br', 'hr']: # Exceptions for tags that are empty by design
-                tag.decompose()
+        for tag in tree.xpath("//*[not(node()) and not(self::br) and not(self::hr)]"): # Exceptions for tags that are empty by design
+            if tag.getparent() is not None:
+                tag.drop_tree() # Keeps the text that follows the tag
 
-        return str(soup)
+        return lxml_html.tostring(tree, encoding='unicode')
 
     def html_clean_html2text(self, html_content):
-        """Converts HTML to Markdown using html2text."""
-        h = html2text.HTML2Text()
-
-        # Podstawowa konfiguracja
-        h.ignore_links = True        # zachowuje linki
-        h.ignore_images = True        # ignoruje obrazy
-        h.ignore_emphasis = True      # ignoruje pogrubienia/kursywy
-        h.body_width = 0             # wyłącza zawijanie tekstu
-
-        # Bardziej zaawansowana konfiguracja
-        h.protect_links = True       # zachowuje pełne URLe
-        h.unicode_snob = True        # zachowuje znaki unicode
-        h.skip_internal_links = True # pomija wewnętrzne linki
-        h.inline_links = True        # linki w tekście, nie na końcu
-
-        #h.ignore_tables = False      # zachowa tabele
-        #h.bypass_tables = False      # zachowa formatowanie tabel
+        """Converts HTML (string or lxml tree) to Markdown using markdownify."""
+        if not isinstance(html_content, str):
+            html_content = lxml_html.tostring(html_content, encoding='unicode')
 
         # Convert HTML to markdown and clean up empty lines
-        markdown_text = h.handle(html_content)
+        markdown_text = self._markdown_converter.convert(html_content)
         # Remove multiple empty lines and strip whitespace
         #cleaned_text = '\n'.join(line.strip() for line in markdown_text.splitlines() if line.strip())
         cleaned_text = self.text_cleaner(markdown_text)
@@ -216,19 +287,17 @@ class Tools:
 
     @property
     def session(self):
-        """Get or create a requests session with proper configuration."""
-        if self._session is None:
-            self._session = requests.Session()
-            if not self.valves.verify_ssl:
-                # Disable SSL verification warnings when verify_ssl is False
-                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-                self._session.verify = False
-            if self.valves.firecrawl_api_key:
-                self._session.headers.update({
-                    "Authorization": f"Bearer {self.valves.firecrawl_api_key}",
-                    "Content-Type": "application/json",
-                })
-        return self._session
+        """Get the shared aiohttp session; SSL and auth are applied per request."""
+        return get_session()
+
+    def _format_result(self, url, metadata, pretty_content):
+        """Builds the tool output: a header with the current date and metadata, followed by the page content."""
+        return (
+            f"Date now: {datetime.now():%Y-%m-%d %H:%M:%S}\n"
+            f"Page content from URL: {url}\n"
+            f"Metadata: {metadata}\n"
+            f"{pretty_content}\n"
+        ).strip()
 
     async def web_scrape(
         self, url: str, __user__: dict = None, __event_emitter__=None
@@ -248,25 +317,40 @@ class Tools:
 
 
             # Ensure we always have 'html' format if any other format starting from 'html2*' is present
-            if any(format.startswith("html2") for format in self.valves.formats):
-                self.valves.formats.insert(0, 'html')
-                self._skip_html = True
+            # Work on a local list, the valves are shared between concurrent calls
+            if any(format.startswith("html2") for format in self.valves.formats) and 'html' not in self.valves.formats:
+                effective_formats = ['html', *self.valves.formats]
+            else:
+                effective_formats = list(self.valves.formats)
 
             # Check if url starts from http: or https:
             if not url.startswith("http://") and not url.startswith("https://"):
                 url = f"https://{url}"
 
+            # Reuse a recent scrape of the same URL made with the same endpoint and request options
+            cache_key = (
+                url,
+                tuple(self.valves.formats),
+                self.valves.firecrawl_api_url,
+                orjson.dumps(self.valves.payload_extras, option=orjson.OPT_SORT_KEYS),
+            )
+            hit = self._cache.get(cache_key)
+            if hit is not None and time.monotonic() - hit[0] < _CACHE_TTL:
+                self._cache.move_to_end(cache_key)
+                if __event_emitter__:
+                    await event_emitter.success_update(f"Firecrawl returned cached content for {url}")
+                return self._format_result(url, hit[1], hit[2])
+
             # We need to remove all formats which are starts like: html2
             payload = {
                 "url": url,
-                "formats": [format for format in self.valves.formats if not format.startswith("html2")]
+                "formats": [format for format in effective_formats if not format.startswith("html2")]
             }
             
             # Add optional parameters only if they're not default values
-            optional_params = self.valves.dict(exclude={'firecrawl_api_url', 'firecrawl_api_key', 'formats'})
-            payload.update(optional_params)
+            payload.update(self.valves.payload_extras)
 
-            logger.debug(f"Request payload: {payload}")
+            logger.debug("Request payload: %s", payload)
 
             print(f"Firecrawl Tool request for url: {url} - payload: {payload}")
             
@@ -277,29 +361,29 @@ class Tools:
             # Make the request
             base_url = self.valves.firecrawl_api_url.rstrip('/')
             endpoint = f"{base_url}/scrape"
-            logger.debug(f"Making request to endpoint: {endpoint}")
+            logger.debug("Making request to endpoint: %s", endpoint)
             
-            response = requests.post(
+            async with self.session.post(
                 endpoint,
                 json=payload,
                 headers={"Authorization": f"Bearer {self.valves.firecrawl_api_key}"},
-                verify=self.valves.verify_ssl,
-                timeout=self.valves.timeout
-            )
-            logger.debug(f"Response status code: {response.status_code}")
-            
-            if response.status_code != 200:
-                if response.status_code == 400:
-                    error_msg = f"Error: Failed to scrape URL. Status code: {response.status_code} - payload send: {payload}"
-                else:
-                    error_msg = f"Error: Failed to scrape URL. Status code: {response.status_code}"
-                if __event_emitter__:
-                    await event_emitter.error_update(error_msg)
-                return error_msg
-           
-            # Parse the response
-            response_data = response.json()
-            logger.debug(f"Raw response data: {response_data}")
+                ssl=self.valves.verify_ssl,
+                timeout=aiohttp.ClientTimeout(total=self.valves.timeout)
+            ) as response:
+                logger.debug("Response status code: %s", response.status)
+
+                if response.status != 200:
+                    if response.status == 400:
+                        error_msg = f"Error: Failed to scrape URL. Status code: {response.status} - payload send: {payload}"
+                    else:
+                        error_msg = f"Error: Failed to scrape URL. Status code: {response.status}"
+                    if __event_emitter__:
+                        await event_emitter.error_update(error_msg)
+                    return error_msg
+
+                # Parse the response
+                response_data = orjson.loads(await response.read())
+            logger.debug("Raw response data: %s", response_data)
             
             if not response_data.get("success"):
                 error_msg = f"Error: {response_data.get('error', 'Unknown error occurred')}"
@@ -308,10 +392,12 @@ class Tools:
                 return error_msg
             
             # Extract content based on format
-            data = response_data.get("data", {}).get(self.valves.formats[0])
+            data_section = response_data.get("data", {})
+            data_html = data_section.get("html")
+            data = data_section.get(effective_formats[0])
             
             if not data:
-                error_msg = f"Error: No content found in {self.valves.formats[0]} format"
+                error_msg = f"Error: No content found in {effective_formats[0]} format"
                 if __event_emitter__:
                     await event_emitter.error_update(error_msg)
                 return error_msg
@@ -321,43 +407,48 @@ class Tools:
                 await event_emitter.success_update(f"Firecrawl successfully scraped content from {url}")
             
             
-            if self._skip_html:
-                self.valves.formats.pop(0)
-
             # Return the content
             #print("URL: " + str(url))
             content = {}
+            cleaned_html = None
+            if any(format.startswith("html2") for format in self.valves.formats):
+                # Parse and clean the page once, shared by html2text and html2bs4,
+                # in a worker thread so the event loop keeps serving other calls
+                cleaned_html = await asyncio.to_thread(self.html_clean_bs4, data_html)
+            pending = {}
             for format in self.valves.formats:
-                data = response_data.get("data", {}).get(format, "")
-                data_html = response_data.get("data", {}).get("html")
-                content[format] = None
-                if format == "html":
-                    content[format] = str(data)
-                if format == "markdown":
-                    content[format] = self.text_cleaner(data)
-
-                if format == "html2text":
-                    content["html2text"] = str(self.text_cleaner(self.html_clean_html2text(data_html)))
-                if format == "html2bs4" :
-                    content["html2bs4"] = str(self.text_cleaner(self.html_clean_bs4(data_html)))
-            
-                if content[format] is None:
+                data = data_section.get(format, "")
+                formatter = self._formatters.get(format)
+                if formatter is None:
+                    # Formats returned by Firecrawl as-is (html, links, ...)
                     content[format] = data
+                else:
+                    content[format] = None  # Keeps the configured output order
+                    pending[format] = asyncio.to_thread(formatter, data, cleaned_html)
 
                 #print(f"Tokens for format: " + format + ": " + str(self.num_tokens_from_string(content[format], "cl100k_base")) + "[cl100k_base] / " + str(self.num_tokens_from_string(content[format], "o200k_base")) + "[o200k_base] - content len: "+ str(len(content[format])) + " chars")
 
+            # Run the text conversions concurrently in worker threads
+            # (nothing to do when only raw Firecrawl formats were requested)
+            if pending:
+                for format, result in zip(pending, await asyncio.gather(*pending.values())):
+                    content[format] = result
+
             # Lets return content
-            formatted_content = json.dumps(content, indent=4, ensure_ascii=False)
-            decoded_content = json.loads(formatted_content)
-            pretty_content = json.dumps(decoded_content, indent=4, ensure_ascii=False).replace('\\n', '\n')
-            return (    f"""Date now: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n""" +
-                        f"""Page content from URL: {url}\n"""+
-                        f"""Metadata: {response_data.get("data", {}).get("metadata")}\n"""+
-                        f"""{pretty_content}\n""").strip()
+            pretty_content = ''.join(f"{format}:\n{value}\n\n" for format, value in content.items())
+            metadata = data_section.get('metadata')
+
+            # Cache only the page content of successful scrapes, evicting the least recently used entries;
+            # the header is rebuilt on every call so its date stays current
+            self._cache[cache_key] = (time.monotonic(), metadata, pretty_content)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > _CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return self._format_result(url, metadata, pretty_content)
 
         except Exception as e:
             error_msg = f"Error: {str(e)}"
-            logger.error(f"Exception during web scrape: {e}")
+            logger.error("Exception during web scrape: %s", e)
             if __event_emitter__:
                 await event_emitter.error_update(error_msg)
             return error_msg
@@ -371,14 +462,17 @@ if __name__ == "__main__":
     tools.valves.firecrawl_api_url = "https://firecrawl.self.hosted/v1/"
     tools.valves.verify_ssl = False
     tools.valves.firecrawl_api_key = "sk-1234"  # Replace with your actual API key
-    tools.valves.formats = [ "html2text", "html2bs4" ]
+    tools.valves.formats = [ "html2text" ]
     
     # Test payload matching the curl command
     test_url = "https://cnn.com/"
 
     # Run the test
     async def run_test():
-        result = await tools.web_scrape(test_url)
-        print(f"\nResult:\n{result}")
+        try:
+            result = await tools.web_scrape(test_url)
+            print(f"\nResult:\n{result}")
+        finally:
+            await close_session()
 
     asyncio.run(run_test())